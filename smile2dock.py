@@ -8,198 +8,637 @@ elvis.afmartis@gmail.com
 """
 
 import os
+import sys
+import json
 import argparse
+import contextlib
+import csv
+import functools
+import itertools
 import logging
+import multiprocessing
+import random
+import shutil
+import signal
+import threading
 from rdkit import Chem
-from rdkit.Chem import AllChem, Descriptors, DataStructs, rdMolDescriptors, Crippen
-from rdkit.Chem.Fingerprints import FingerprintMols
+from rdkit.Chem import AllChem, DataStructs, rdMolDescriptors, rdFingerprintGenerator, Crippen
+from rdkit.Geometry import Point3D
 from openbabel import pybel
 import dimorphite_dl
+import numpy as np
+
+try:
+    # Optional: CUDA conformer generation and MMFF optimization for --gpu
+    from nvmolkit.embedMolecules import EmbedMolecules as nvmolkit_embed
+    from nvmolkit.mmffOptimization import MMFFOptimizeMoleculesConfs as nvmolkit_mmff_optimize
+except ImportError:
+    nvmolkit_embed = nvmolkit_mmff_optimize = None
+
+try:
+    # Optional: persistent protonation cache for --protonation_cache
+    import diskcache
+except ImportError:
+    diskcache = None
 
 # Ensure logging is configured
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
+# Parsed molecules are pickled to the batch workers; keep mol-level properties such as
+# _Name (the ID column of a .smi line), which become the titles of the exported files
+Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.MolProps | Chem.PropertyPickleOptions.PrivateProps)
+
+OUTPUT_FORMATS = ("pdb", "mol2", "sdf", "pdbqt")
+OPENBABEL_FORMATS = ("mol2", "pdbqt")  # The rest are written directly by RDKit
+EMBED_TIMEOUT = 30  # seconds per EmbedMultipleConfs call
+PROTONATION_FLUSH_ROWS = 1000  # buffered protonation_states.txt rows per write
+
+# RDKit numThreads for embedding/optimization: 0 uses every core, pool workers use 1
+_rdkit_threads = 0
+
+# Directories already created by ensure_output_dir in this process
+_ensured_dirs = set()
+
 def ensure_output_dir(output_base):
     """Create the output directory if it does not exist."""
     out_dir = os.path.dirname(output_base)
-    if out_dir and not os.path.exists(out_dir):
+    if out_dir and out_dir not in _ensured_dirs:
         os.makedirs(out_dir, exist_ok=True)
+        _ensured_dirs.add(out_dir)
+
+# On-disk protonation cache shared across runs and processes (see set_protonation_cache)
+_protonation_cache = None
+
+def set_protonation_cache(cache_dir):
+    """Back protonate_smiles with a persistent diskcache in cache_dir (None disables it)"""
+    global _protonation_cache
+    _protonation_cache = None
+    if cache_dir is None:
+        return
+    if diskcache is None:
+        logging.warning("diskcache is not installed; protonation results are only cached in memory")
+        return
+    _protonation_cache = diskcache.Cache(cache_dir)
+
+@functools.lru_cache(maxsize=100_000)
+def _protonate_cached(smiles, ph_min, ph_max, precision, max_variants):
+    """Memoized Dimorphite-DL call; returns a tuple so results stay immutable while cached"""
+    key = (smiles, ph_min, ph_max, precision, max_variants)
+    if _protonation_cache is not None:
+        variants = _protonation_cache.get(key)
+        if variants is not None:
+            return variants
+    variants = tuple(dimorphite_dl.protonate_smiles(
+        smiles, 
+        ph_min=ph_min, 
+        ph_max=ph_max, 
+        precision=precision,
+        max_variants=max_variants
+    ))
+    if _protonation_cache is not None:
+        _protonation_cache.set(key, variants)
+    return variants
 
 def protonate_smiles(smiles, ph_min=6.4, ph_max=8.4, precision=1.0, max_variants=128):
     """Protonate SMILES using Dimorphite-DL for specified pH range"""
     try:
-        protonated_smiles = dimorphite_dl.protonate_smiles(
-            smiles, 
-            ph_min=ph_min, 
-            ph_max=ph_max, 
-            precision=precision,
-            max_variants=max_variants
-        )
-        return protonated_smiles
+        return list(_protonate_cached(smiles, ph_min, ph_max, precision, max_variants))
     except Exception as e:
         print(f"Error protonating {smiles}: {str(e)}")
         return [smiles]  # Return original if protonation fails
 
-def smiles_to_3d(smiles, output_base="molecule", num_confs=10, optimize=True, protonate=False, ph_min=6.4, ph_max=8.4):
-    """Convert SMILES to multiple 3D formats and calculate properties"""
-    protonated_variants = None  # Always define so return is consistent
-    try:
-        # Protonate SMILES if requested
-        if protonate:
-            protonated_variants = protonate_smiles(smiles, ph_min, ph_max)
-            print(f"Generated {len(protonated_variants)} protonation states for pH {ph_min}-{ph_max}")
-            for i, variant in enumerate(protonated_variants):
-                print(f"  Variant {i+1}: {variant}")
-            
-            # Use the first variant for 3D generation (or let user choose)
-            if len(protonated_variants) > 1:
-                print(f"Using first protonation variant: {protonated_variants[0]}")
-            smiles = protonated_variants[0]
-        else:
-            protonated_variants = [smiles]
+def _prepare_mol(smiles, protonate=False, ph_min=6.4, ph_max=8.4, mol=None):
+    """Protonate (optionally) and parse a SMILES; returns (2D mol or None, variants, SMILES used)
 
-        # RDKit: Parse and add hydrogens
+    A mol already parsed from smiles is reused unless protonation replaces the SMILES.
+    """
+    # Protonate SMILES if requested
+    if protonate:
+        protonated_variants = protonate_smiles(smiles, ph_min, ph_max)
+        print(f"Generated {len(protonated_variants)} protonation states for pH {ph_min}-{ph_max}")
+        for i, variant in enumerate(protonated_variants):
+            print(f"  Variant {i+1}: {variant}")
+
+        # Use the first variant for 3D generation (or let user choose)
+        if len(protonated_variants) > 1:
+            print(f"Using first protonation variant: {protonated_variants[0]}")
+        smiles = protonated_variants[0]
+    else:
+        protonated_variants = [smiles]
+
+    # RDKit: Parse the variant actually used (hydrogens are only added for 3D generation)
+    if protonate or mol is None:
         mol = Chem.MolFromSmiles(smiles)
-        if mol is None:
-            logging.error(f"Invalid SMILES: {smiles}")
-            return None, None, protonated_variants
-        mol = Chem.AddHs(mol)
-        # Generate 3D conformers
+    if mol is None:
+        logging.error(f"Invalid SMILES: {smiles}")
+    return mol, protonated_variants, smiles
+
+def _embed_conformers(mol, num_confs, smiles):
+    """Generate 3D conformers with ETKDGv3, with bounded retries so one SMILES cannot stall a batch"""
+    params = AllChem.ETKDGv3()
+    params.randomSeed = 42
+    params.enforceChirality = True
+    params.numThreads = _rdkit_threads
+    if hasattr(params, "timeout"):  # Only available in recent RDKit releases
+        params.timeout = EMBED_TIMEOUT
+    conf_ids = AllChem.EmbedMultipleConfs(mol, numConfs=num_confs, params=params)
+    if not conf_ids:
+        # Fused/bridged ring systems often only embed from random starting coordinates
+        logging.warning(f"Embedding failed for {smiles}; retrying with random coordinates")
+        params.useRandomCoords = True
+        params.maxIterations = 200
+        conf_ids = AllChem.EmbedMultipleConfs(mol, numConfs=num_confs, params=params)
+    if not conf_ids:
+        # Last resort: lift 2D coordinates slightly out of plane and let the force field relax them
+        logging.warning(f"Embedding failed for {smiles}; starting from 2D coordinates")
+        AllChem.Compute2DCoords(mol)
+        rng = random.Random(42)
+        conf = mol.GetConformer()
+        for atom_idx in range(mol.GetNumAtoms()):
+            pos = conf.GetAtomPosition(atom_idx)
+            conf.SetAtomPosition(atom_idx, Point3D(pos.x, pos.y, rng.uniform(-0.5, 0.5)))
+        conf.Set3D(True)
+        conf_ids = [conf.GetId()]
+    return conf_ids
+
+def _optimize_conformers(mol, smiles):
+    """Optimize all conformers with one MMFF94s force field (UFF fallback); returns per-conformer energies or None"""
+    # Atom typing and force-field setup happen once; every conformer reuses the same force field.
+    # Interfragment interactions are ignored by default, so salts/mixtures need no splitting.
+    mp = AllChem.MMFFGetMoleculeProperties(mol, mmffVariant='MMFF94s')
+    if mp is None:
+        logging.warning(f"MMFF typing failed for {smiles}; falling back to UFF")
+        ff = AllChem.UFFGetMoleculeForceField(mol)
+    else:
+        ff = AllChem.MMFFGetMoleculeForceField(mol, mp)
+    if ff is None:
+        logging.warning(f"Could not set up a force field for {smiles}; keeping embedded geometries")
+        return None
+
+    # Conformers are optimized on RDKit's own thread pool.
+    # Keep numThreads=1 if distance constraints are ever added to this path.
+    results = AllChem.OptimizeMoleculeConfs(mol, ff, numThreads=_rdkit_threads, maxIters=1000)
+    for conf_id, (status, _energy) in enumerate(results):
+        if status != 0:
+            logging.warning(f"Optimization failed or did not converge for conformer {conf_id} of {smiles} (status {status})")
+    return [energy for _status, energy in results]
+
+def generate_3d(mol, num_confs=10, optimize=True, smiles=None):
+    """Add hydrogens and generate (optionally optimized) 3D conformers; returns (3D mol, energies)"""
+    mol = Chem.AddHs(mol)
+    _embed_conformers(mol, num_confs, smiles)
+    energies = _optimize_conformers(mol, smiles) if optimize else None
+    return mol, energies
+
+def compute_properties(mol):
+    """Calculate physicochemical descriptors for a molecule"""
+    try:
+        return {
+            "Molecular Weight": rdMolDescriptors.CalcExactMolWt(mol),
+            "Crippen_LogP": Crippen.MolLogP(mol),
+            "Crippen_MR": Crippen.MolMR(mol),
+            "H-Bond Donors": rdMolDescriptors.CalcNumHBD(mol),
+            "H-Bond Acceptors": rdMolDescriptors.CalcNumHBA(mol),
+            "TPSA": rdMolDescriptors.CalcTPSA(mol),
+            "Rotatable Bonds": rdMolDescriptors.CalcNumRotatableBonds(mol),
+            "#Aliphatic Rings": rdMolDescriptors.CalcNumAliphaticRings(mol),
+            "#Aromatic Rings": rdMolDescriptors.CalcNumAromaticRings(mol),
+            "#Heteroaromatic Rings": rdMolDescriptors.CalcNumHeterocycles(mol)
+        }
+    except Exception as e:
+        logging.error(f"Property calculation failed: {e}")
+        return {}
+
+def export_3d(mol, output_base, energies=None):
+    """Write all output formats for an embedded molecule; returns False on failure
+
+    With per-conformer energies, the SDF lists every conformer from lowest to highest
+    energy and the single-structure formats get the lowest-energy conformer.
+    """
+    # Ensure output directory exists
+    ensure_output_dir(output_base)
+
+    conf_ids = [conf.GetId() for conf in mol.GetConformers()]
+    if energies is not None and len(energies) == len(conf_ids):
+        ranked = sorted(zip(conf_ids, energies), key=lambda c: c[1])
+    else:
+        ranked = [(conf_id, None) for conf_id in conf_ids]
+
+    # RDKit writes SDF (all conformers) and PDB (best conformer) natively
+    sdf_file = f"{output_base}.sdf"
+    try:
+        writer = Chem.SDWriter(sdf_file)
+        for conf_id, energy in ranked:
+            if energy is not None:
+                mol.SetProp("Energy", f"{energy:.4f}")
+            writer.write(mol, confId=conf_id)
+        writer.close()
+    except Exception as e:
+        logging.error(f"Failed to write {sdf_file}: {e}")
+        return False
+    finally:
+        if mol.HasProp("Energy"):
+            mol.ClearProp("Energy")
+    try:
+        Chem.MolToPDBFile(mol, f"{output_base}.pdb", confId=ranked[0][0])
+    except Exception as e:
+        logging.error(f"Failed to write {output_base}.pdb: {e}")
+
+    # Only mol2/pdbqt need OpenBabel, which reads the best conformer back from the SDF's first record
+    try:
+        ob_mol = next(pybel.readfile("sdf", sdf_file))
+    except Exception as e:
+        logging.error(f"OpenBabel conversion failed: {e}")
+        return False
+
+    for fmt in OPENBABEL_FORMATS:
+        output = f"{output_base}.{fmt}"
         try:
-            AllChem.EmbedMultipleConfs(
-                mol,
-                numConfs=num_confs,
-                randomSeed=42,
-                enforceChirality=True
-            )
+            ob_mol.write(fmt, output, overwrite=True)
         except Exception as e:
-            logging.error(f"Conformer generation failed for {smiles}: {e}")
+            logging.error(f"Failed to write {output}: {e}")
+    return True
+
+def _describe(mol, mol_3d, output_base, energies, calc_properties):
+    """Export mol_3d (if given) and compute the 2D properties of mol; returns properties or None on failure"""
+    if mol_3d is not None and not export_3d(mol_3d, output_base, energies):
+        return None
+    return compute_properties(mol) if calc_properties else {}
+
+def smiles_to_3d(smiles, output_base="molecule", num_confs=10, optimize=True, protonate=False, ph_min=6.4, ph_max=8.4,
+                 make_3d=True, calc_properties=True, mol=None):
+    """Convert SMILES to multiple 3D formats and calculate properties
+
+    Returns (mol, properties, protonation variants). mol is the parsed 2D molecule,
+    which properties and fingerprints are computed from; it is None on failure.
+    With make_3d=False no conformers or files are generated. Pass mol if the SMILES
+    has already been parsed to skip parsing it again.
+    """
+    protonated_variants = None  # Always define so return is consistent
+    try:
+        mol, protonated_variants, smiles = _prepare_mol(smiles, protonate, ph_min, ph_max, mol)
+        if mol is None:
             return None, None, protonated_variants
 
-        if optimize:
-            for conf_id in range(mol.GetNumConformers()):
-                try:
-                    AllChem.MMFFOptimizeMolecule(
-                        mol,
-                        confId=conf_id,
-                        mmffVariant='MMFF94s',
-                        maxIters=1000
-                    )
-                except Exception as e:
-                    logging.warning(f"Optimization failed for conformer {conf_id} of {smiles}: {e}")
-
-        # Convert to OpenBabel molecule for format export
-        try:
-            sdf_data = Chem.MolToMolBlock(mol)
-            ob_mol = pybel.readstring("mol", sdf_data)
-        except Exception as e:
-            logging.error(f"OpenBabel conversion failed: {e}")
+        mol_3d = energies = None
+        if make_3d:
+            mol_3d, energies = generate_3d(mol, num_confs, optimize, smiles)
+
+        properties = _describe(mol, mol_3d, output_base, energies, calc_properties)
+        if properties is None:
             return None, None, protonated_variants
+        return mol, properties, protonated_variants
+
+    except Exception as e:
+        logging.error(f"Error processing {smiles}: {e}")
+        return None, None, protonated_variants
+
+def gpu_embed_and_optimize(mols, num_confs=10, optimize=True):
+    """Embed (and MMFF-optimize) a list of molecules with Hs on the GPU using nvMolKit
 
-        # Ensure output directory exists
-        ensure_output_dir(output_base)
+    The GPU optimizer uses plain MMFF94; the CPU path (_optimize_conformers) uses MMFF94s.
 
-        # Write different file formats
-        for fmt in ["pdb", "mol2", "sdf", "pdbqt"]:
-            output = f"{output_base}.{fmt}"
+    Returns per-conformer energies for each molecule (None where it was not optimized).
+    """
+    params = AllChem.ETKDGv3()
+    params.randomSeed = 42
+    params.enforceChirality = True
+    params.useRandomCoords = True  # The nvMolKit embedder only starts from random coordinates
+    try:
+        nvmolkit_embed(mols, params, confsPerMolecule=num_confs)
+    except Exception as e:
+        logging.error(f"GPU conformer generation failed, falling back to CPU: {e}")
+
+    # Molecules the GPU embedder declined are embedded on the CPU instead
+    for mol in mols:
+        if mol.GetNumConformers() == 0:
+            smiles = Chem.MolToSmiles(Chem.RemoveHs(mol))
+            logging.warning(f"GPU embedding failed for {smiles}; using CPU embedding")
             try:
-                ob_mol.write(fmt, output, overwrite=True)
+                _embed_conformers(mol, num_confs, smiles)
             except Exception as e:
-                logging.error(f"Failed to write {output}: {e}")
+                logging.error(f"Conformer generation failed for {smiles}: {e}")
 
-        # Calculate properties (corrected descriptors)
+    energies = [None] * len(mols)
+    if optimize:
+        embedded = [i for i, mol in enumerate(mols) if mol.GetNumConformers() > 0]
         try:
-            properties = {
-                "Molecular Weight": Descriptors.ExactMolWt(mol),
-                "Crippen_LogP": Crippen.MolLogP(mol),
-                "Crippen_MR": Crippen.MolMR(mol),
-                "H-Bond Donors": Descriptors.NumHDonors(mol),
-                "H-Bond Acceptors": Descriptors.NumHAcceptors(mol),
-                "TPSA": Descriptors.TPSA(mol),
-                "Rotatable Bonds": Descriptors.NumRotatableBonds(mol),
-                "#Aliphatic Rings": rdMolDescriptors.CalcNumAliphaticRings(mol),
-                "#Aromatic Rings": rdMolDescriptors.CalcNumAromaticRings(mol),
-                "#Heteroaromatic Rings": rdMolDescriptors.CalcNumHeterocycles(mol)
-            }
+            gpu_energies = nvmolkit_mmff_optimize([mols[i] for i in embedded], maxIters=1000)
+            for i, mol_energies in zip(embedded, gpu_energies):
+                energies[i] = list(mol_energies)
         except Exception as e:
-            logging.error(f"Property calculation failed: {e}")
-            properties = {}
+            logging.error(f"GPU optimization failed, falling back to CPU: {e}")
+            for i in embedded:
+                energies[i] = _optimize_conformers(mols[i], Chem.MolToSmiles(Chem.RemoveHs(mols[i])))
+    return energies
+
+@functools.lru_cache(maxsize=None)
+def _fp_generator(fp_type="morgan", radius=2, n_bits=2048):
+    """Reusable fingerprint generator, built once per settings in each process"""
+    # Both generators emit exactly n_bits bits, so every fingerprint of a run can be
+    # scored in one bulk sweep (folded FingerprintMols vectors differ in length)
+    if fp_type == "morgan":
+        return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits)
+    return rdFingerprintGenerator.GetRDKitFPGenerator(fpSize=n_bits)
+
+def calculate_fingerprint(mol, fp_type="morgan", radius=2, n_bits=2048):
+    """Calculate a Morgan or RDKit topological fingerprint for a molecule"""
+    return _fp_generator(fp_type, radius, n_bits).GetFingerprint(mol)
+
+def calculate_fingerprints(mols, fp_type="morgan", radius=2, n_bits=2048):
+    """Calculate fingerprints for a list of molecules, in one batched call where RDKit supports it"""
+    generator = _fp_generator(fp_type, radius, n_bits)
+    if hasattr(generator, "GetFingerprints"):  # RDKit >= 2024.03
+        return list(generator.GetFingerprints(mols, numThreads=_rdkit_threads))
+    return [generator.GetFingerprint(mol) for mol in mols]
+
+def reference_fingerprint(reference_smiles, fp_type="morgan", radius=2, n_bits=2048):
+    """Parse the reference SMILES once and return its fingerprint (None if missing or invalid)"""
+    if not reference_smiles:
+        return None
+    ref_mol = Chem.MolFromSmiles(reference_smiles)
+    if ref_mol is None:
+        logging.error(f"Invalid reference SMILES: {reference_smiles}")
+        return None
+    return calculate_fingerprint(ref_mol, fp_type, radius, n_bits)
 
-        return mol, properties, protonated_variants
+def _tanimoto_fps(fp1, fp2):
+    """Tanimoto similarity between two precomputed fingerprints"""
+    if fp1 is None or fp2 is None:
+        logging.warning("One or both fingerprints are None, cannot calculate similarity.")
+        return None
+    return DataStructs.TanimotoSimilarity(fp1, fp2)
 
+def fp_to_u64(fp):
+    """Pack an RDKit bit vector into a uint64 array for vectorized popcount Tanimoto"""
+    bits = np.zeros(fp.GetNumBits(), dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(fp, bits)
+    packed = np.packbits(bits)
+    pad = -len(packed) % 8
+    if pad:
+        packed = np.concatenate([packed, np.zeros(pad, dtype=np.uint8)])
+    return packed.view(np.uint64)
+
+def _popcount_u64(a):
+    """Per-element popcount of a uint64 array"""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        return np.bitwise_count(a)
+    # SWAR fallback for older NumPy
+    a = a - ((a >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    a = (a & np.uint64(0x3333333333333333)) + ((a >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    a = (a + (a >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (a * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def bulk_tanimoto_u64(query, matrix):
+    """Tanimoto similarity of one packed fingerprint against an (N, words) matrix of packed fingerprints"""
+    if matrix.shape[1] != query.shape[0]:
+        raise ValueError("All fingerprints must have the same number of bits for bulk Tanimoto similarity")
+    inter = _popcount_u64(matrix & query).sum(axis=1, dtype=np.uint64)
+    union = _popcount_u64(matrix | query).sum(axis=1, dtype=np.uint64)
+    return np.divide(inter, union, out=np.zeros(len(matrix)), where=union > 0)
+
+def _raise_system_exit(signum, frame):
+    """Signal handler that unwinds the batch loop so open output files get flushed"""
+    raise SystemExit(128 + signum)
+
+def _init_worker(protonation_cache=None):
+    """Pool initializer: per-process setup for batch workers"""
+    global _rdkit_threads
+    # The pool already uses one process per core, so each worker stays single-threaded
+    _rdkit_threads = 1
+    # Workers must die quietly on pool.terminate(), not run the parent's SIGTERM handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    set_protonation_cache(protonation_cache)
+
+def _process_one(task):
+    """Process one SMILES of a batch; runs in a worker process, so it must stay top-level"""
+    (idx, smiles, mol, output_dir, num_confs, protonate, ph_min, ph_max, make_3d, calc_properties,
+     want_fp, fp_type, radius, n_bits) = task
+    base_name = os.path.join(output_dir, f"mol_{idx+1}")
+    mol, props, protonated_variants = smiles_to_3d(
+        smiles, base_name, num_confs, protonate=protonate, ph_min=ph_min, ph_max=ph_max,
+        make_3d=make_3d, calc_properties=calc_properties, mol=mol
+    )
+    fp = fp_to_u64(calculate_fingerprint(mol, fp_type, radius, n_bits)) if mol is not None and want_fp else None
+    return idx, smiles, props, protonated_variants, fp
+
+def _task_chunksize(n_tasks, n_workers):
+    """Chunk size for seconds-long 3D tasks: small enough to keep every worker busy on small batches"""
+    return max(1, min(32, n_tasks // (4 * n_workers)))
+
+def _export_one(task):
+    """Export one GPU-embedded molecule of a batch; worker counterpart of _process_one"""
+    idx, smiles, mol, mol_3d, energies, protonated_variants, output_dir, calc_properties, fp = task
+    try:
+        props = _describe(mol, mol_3d, os.path.join(output_dir, f"mol_{idx+1}"), energies, calc_properties)
     except Exception as e:
         logging.error(f"Error processing {smiles}: {e}")
-        return None, None, protonated_variants
+        props = None
+    return idx, smiles, props, protonated_variants, fp if props is not None else None
+
+def _gpu_export_tasks(lines, output_dir, num_confs, protonate, ph_min, ph_max, calc_properties,
+                      want_fp, fp_type, radius, n_bits):
+    """Prepare every molecule of a batch, embed them together on the GPU and build _export_one tasks
+
+    Returns (tasks, failed): failed holds ready-made failure results, in _export_one's
+    format, for molecules that could not be prepared or embedded.
+    """
+    prepared, failed = [], []
+    for idx, smiles, mol in lines:
+        mol, protonated_variants, _ = _prepare_mol(smiles, protonate, ph_min, ph_max, mol)
+        if mol is not None:
+            prepared.append((idx, smiles, mol, Chem.AddHs(mol), protonated_variants))
+        else:
+            failed.append((idx, smiles, None, protonated_variants, None))
 
-def calculate_tanimoto_similarity(mol1, mol2, fp_type="morgan", radius=2, n_bits=2048):
-    """Calculate Tanimoto similarity between two molecules"""
-    if mol1 is None or mol2 is None:
-        logging.warning("One or both molecules are None, cannot calculate similarity.")
-        return None
-    if fp_type == "morgan":
-        fp1 = AllChem.GetMorganFingerprintAsBitVect(mol1, radius, nBits=n_bits)
-        fp2 = AllChem.GetMorganFingerprintAsBitVect(mol2, radius, nBits=n_bits)
+    energies = gpu_embed_and_optimize([mol_3d for _, _, _, mol_3d, _ in prepared], num_confs)
+    # The whole batch is already in this process, so fingerprint it in one call
+    if want_fp:
+        fps = [fp_to_u64(fp) for fp in calculate_fingerprints([mol for _, _, mol, _, _ in prepared], fp_type, radius, n_bits)]
     else:
-        fp1 = FingerprintMols.FingerprintMol(mol1)
-        fp2 = FingerprintMols.FingerprintMol(mol2)
-    return DataStructs.TanimotoSimilarity(fp1, fp2)
+        fps = [None] * len(prepared)
+    tasks = []
+    for (idx, smiles, mol, mol_3d, protonated_variants), mol_energies, fp in zip(prepared, energies, fps):
+        if mol_3d.GetNumConformers() > 0:
+            tasks.append((idx, smiles, mol, mol_3d, mol_energies, protonated_variants, output_dir, calc_properties, fp))
+        else:
+            failed.append((idx, smiles, None, protonated_variants, None))
+    return tasks, failed
+
+def parse_canonical(smiles):
+    """Parse a SMILES; returns (mol, canonical SMILES), or (None, None) if it cannot be parsed"""
+    mol = Chem.MolFromSmiles(smiles)
+    return (mol, Chem.MolToSmiles(mol)) if mol is not None else (None, None)
+
+def deduplicate_smiles(entries, parsed):
+    """Drop invalid (idx, smiles) entries and split the rest into (idx, smiles, mol) first occurrences
+    and a map of first idx -> later (idx, smiles) duplicates"""
+    first_idx = {}  # canonical SMILES -> idx of its first occurrence
+    unique, duplicates = [], {}
+    for (idx, smiles), (mol, canon) in zip(entries, parsed):
+        if canon is None:
+            logging.error(f"Invalid SMILES: {smiles}")
+        elif canon in first_idx:
+            duplicates.setdefault(first_idx[canon], []).append((idx, smiles))
+        else:
+            first_idx[canon] = idx
+            unique.append((idx, smiles, mol))
+    return unique, duplicates
+
+def _copy_outputs(src_base, dst_base):
+    """Copy the generated files of one molecule to another base name"""
+    for fmt in OUTPUT_FORMATS:
+        try:
+            shutil.copyfile(f"{src_base}.{fmt}", f"{dst_base}.{fmt}")
+        except OSError as e:
+            logging.error(f"Failed to copy {src_base}.{fmt} to {dst_base}.{fmt}: {e}")
 
 def batch_process(input_file, output_dir, reference_smiles=None, fp_type="morgan", radius=2, n_bits=2048, 
-                 protonate=False, ph_min=6.4, ph_max=8.4, num_confs=10):
+                 protonate=False, ph_min=6.4, ph_max=8.4, num_confs=10, nproc=None, gpu=False,
+                 protonation_cache=None, make_3d=True, calc_properties=True):
     """Process a file of SMILES strings with optional protonation and similarity calculation"""
-    if reference_smiles:
-        ref_mol = Chem.MolFromSmiles(reference_smiles)
-        if ref_mol is None:
-            logging.error(f"Invalid reference SMILES: {reference_smiles}")
-            ref_mol = None
-    else:
-        ref_mol = None
-
-    # Create protonation output file if requested
-    protonation_file = None
+    gpu = gpu and make_3d
+    if gpu and nvmolkit_embed is None:
+        logging.warning("nvMolKit is not installed; generating conformers on the CPU")
+        gpu = False
+
+    # The reference fingerprint is computed once; packed query fingerprints come back from the workers
+    ref_fp = reference_fingerprint(reference_smiles, fp_type, radius, n_bits)
+
+    # Create protonation output file if requested; rows are buffered and written in blocks
+    protonation_path = os.path.join(output_dir, "protonation_states.txt")
+    protonation_file = protonation_writer = None
+    protonation_rows = []
+    pending_rows = {}  # idx -> rows of a finished input line that is not yet next in input order
     if protonate:
-        protonation_file = open(os.path.join(output_dir, "protonation_states.txt"), 'w')
-        protonation_file.write(f"Original_SMILES\tProtonated_SMILES\tpH_Range\n")
+        protonation_file = open(protonation_path, 'w', buffering=1 << 20, newline='\n')
+        protonation_writer = csv.writer(protonation_file, delimiter='\t', lineterminator='\n')
+        protonation_writer.writerow(["Original_SMILES", "Protonated_SMILES", "pH_Range"])
 
     with open(input_file) as f:
-        for idx, line in enumerate(f):
-            smiles = line.strip()
-            if smiles:
-                base_name = os.path.join(output_dir, f"mol_{idx+1}")
-                mol, props, protonated_variants = smiles_to_3d(
-                    smiles, base_name, num_confs, protonate=protonate, ph_min=ph_min, ph_max=ph_max
+        entries = [(idx, line.strip()) for idx, line in enumerate(f) if line.strip()]
+
+    fp_records = []  # (idx, smiles, fp) for the similarity sweep after the loop
+    n_workers = nproc or os.cpu_count()
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                initargs=(protonation_cache,))
+    # Turn SIGTERM into SystemExit so buffered protonation rows are flushed on the way out;
+    # signal handlers can only be installed from the main thread (e.g. not from a server thread)
+    previous_sigterm = None
+    if threading.current_thread() is threading.main_thread():
+        previous_sigterm = signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        with pool:
+            # Parse and canonicalize on the pool; invalid SMILES never reach the 3D stage,
+            # duplicate molecules (same canonical SMILES) only go through it once and the
+            # parsed molecules are handed on so nothing is parsed twice
+            parsed = pool.imap(parse_canonical, [smiles for _, smiles in entries], chunksize=256)
+            lines, duplicates = deduplicate_smiles(entries, parsed)
+            n_duplicates = sum(len(d) for d in duplicates.values())
+            if n_duplicates:
+                print(f"Skipping {n_duplicates} duplicate SMILES")
+            # Input lines that will get a result, in the order their protonation rows are written
+            row_order = sorted([idx for idx, _, _ in lines] + [d for dups in duplicates.values() for d, _ in dups])
+            next_row = 0
+
+            if gpu:
+                # Conformers for the whole batch are generated on the GPU; workers only export
+                set_protonation_cache(protonation_cache)
+                tasks, failed = _gpu_export_tasks(
+                    lines, output_dir, num_confs, protonate, ph_min, ph_max, calc_properties,
+                    ref_fp is not None, fp_type, radius, n_bits
                 )
-                if props:
-                    print(f"Processed {smiles}")
-                    print("Properties:", props)
-
-                    # Log protonation states
-                    if protonate and protonated_variants and protonation_file:
-                        for variant in protonated_variants:
-                            protonation_file.write(f"{smiles}\t{variant}\t{ph_min}-{ph_max}\n")
+                # Dropped molecules go through the results loop too, so their duplicates are reported
+                results = itertools.chain(
+                    failed, pool.imap_unordered(_export_one, tasks, chunksize=_task_chunksize(len(tasks), n_workers))
+                )
+            else:
+                tasks = (
+                    (idx, smiles, mol, output_dir, num_confs, protonate, ph_min, ph_max, make_3d, calc_properties,
+                     ref_fp is not None, fp_type, radius, n_bits)
+                    for idx, smiles, mol in lines
+                )
+                results = pool.imap_unordered(_process_one, tasks, chunksize=_task_chunksize(len(lines), n_workers))
 
-                    # Calculate similarity if reference provided
-                    if ref_mol:
-                        similarity = calculate_tanimoto_similarity(mol, ref_mol, fp_type, radius, n_bits)
-                        if similarity is not None:
-                            print(f"Tanimoto similarity to reference: {similarity:.4f}")
+            # Results arrive out of order; all file writes stay in this (parent) process
+            for idx, smiles, props, protonated_variants, fp in results:
+                records = [(idx, smiles)] + duplicates.get(idx, [])
+                if props is not None:
+                    print(f"Processed {smiles}")
+                    if props:
+                        print("Properties:", props)
+
+                    # Duplicates reuse the files, properties and fingerprint of their first occurrence
+                    base_name = os.path.join(output_dir, f"mol_{idx+1}")
+                    for dup_idx, dup_smiles in duplicates.get(idx, []):
+                        if make_3d:
+                            _copy_outputs(base_name, os.path.join(output_dir, f"mol_{dup_idx+1}"))
+                        print(f"Processed {dup_smiles} (duplicate of mol_{idx+1})")
+
+                    for rec_idx, rec_smiles in records:
+                        # Log protonation states
+                        if protonation_writer and protonated_variants:
+                            pending_rows[rec_idx] = [
+                                (rec_smiles, variant, f"{ph_min}-{ph_max}") for variant in protonated_variants
+                            ]
+
+                        if fp is not None:
+                            fp_records.append((rec_idx, rec_smiles, fp))
+                else:
+                    # Duplicates share the failure of their first occurrence
+                    for dup_idx, dup_smiles in duplicates.get(idx, []):
+                        logging.error(f"Failed to process {dup_smiles} (duplicate of failed mol_{idx+1})")
+
+                if protonation_writer:
+                    # Results arrive in completion order, but rows are written in input order
+                    for rec_idx, _ in records:
+                        pending_rows.setdefault(rec_idx, [])
+                    while next_row < len(row_order) and row_order[next_row] in pending_rows:
+                        protonation_rows.extend(pending_rows.pop(row_order[next_row]))
+                        next_row += 1
+
+                    if len(protonation_rows) >= PROTONATION_FLUSH_ROWS:
+                        protonation_writer.writerows(protonation_rows)
+                        protonation_rows.clear()
+                        protonation_file.flush()
+    finally:
+        if previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, previous_sigterm)
+        if protonation_file:
+            # Rows still waiting for an earlier line (e.g. on SIGTERM) are written as they are
+            for idx in sorted(pending_rows):
+                protonation_rows.extend(pending_rows[idx])
+            protonation_writer.writerows(protonation_rows)
+            protonation_file.close()
 
     if protonation_file:
-        protonation_file.close()
-        print(f"Protonation states saved to: {os.path.join(output_dir, 'protonation_states.txt')}")
+        print(f"Protonation states saved to: {protonation_path}")
+
+    # Calculate similarity to the reference for the whole batch in one sweep;
+    # this relies on all fingerprints having the same fixed size (see _fp_generator)
+    if ref_fp is not None and fp_records:
+        fp_records.sort(key=lambda r: r[0])
+        sims = bulk_tanimoto_u64(fp_to_u64(ref_fp), np.vstack([fp for _, _, fp in fp_records]))
+        print("\nTanimoto similarity to reference:")
+        for (idx, smiles, _), similarity in zip(fp_records, sims):
+            print(f"  mol_{idx+1}\t{smiles}\t{similarity:.4f}")
 
 def single_process(smiles, output_base, num_confs, reference_smiles=None, fp_type="morgan", radius=2, n_bits=2048,
-                  protonate=False, ph_min=6.4, ph_max=8.4):
+                  protonate=False, ph_min=6.4, ph_max=8.4, make_3d=True, calc_properties=True):
     """Process a single SMILES string with optional protonation and similarity calculation"""
+    ref_fp = reference_fingerprint(reference_smiles, fp_type, radius, n_bits)
     mol, props, protonated_variants = smiles_to_3d(
-        smiles, output_base, num_confs, protonate=protonate, ph_min=ph_min, ph_max=ph_max
+        smiles, output_base, num_confs, protonate=protonate, ph_min=ph_min, ph_max=ph_max,
+        make_3d=make_3d, calc_properties=calc_properties
     )
 
-    if props:
-        print("Generated files:", [f"{output_base}.{fmt}" for fmt in ["pdb", "mol2", "sdf", "pdbqt"]])
-        print("\nMolecular Properties:")
-        for k, v in props.items():
-            print(f"{k}: {v:.2f}")
+    if mol is not None:
+        if make_3d:
+            print("Generated files:", [f"{output_base}.{fmt}" for fmt in OUTPUT_FORMATS])
+        if props:
+            print("\nMolecular Properties:")
+            for k, v in props.items():
+                print(f"{k}: {v:.2f}")
 
         # Display protonation states
         if protonate and protonated_variants:
@@ -208,14 +647,44 @@ def single_process(smiles, output_base, num_confs, reference_smiles=None, fp_typ
                 print(f"  {i}. {variant}")
 
         # Calculate similarity if reference provided
-        if reference_smiles:
-            ref_mol = Chem.MolFromSmiles(reference_smiles)
-            if ref_mol:
-                similarity = calculate_tanimoto_similarity(mol, ref_mol, fp_type, radius, n_bits)
-                if similarity is not None:
-                    print(f"Tanimoto similarity to reference: {similarity:.4f}")
-            else:
-                print(f"Invalid reference SMILES: {reference_smiles}")
+        if ref_fp is not None:
+            similarity = _tanimoto_fps(calculate_fingerprint(mol, fp_type, radius, n_bits), ref_fp)
+            if similarity is not None:
+                print(f"Tanimoto similarity to reference: {similarity:.4f}")
+
+def serve(output_dir, num_confs=10, reference_smiles=None, fp_type="morgan", radius=2, n_bits=2048,
+          protonate=False, ph_min=6.4, ph_max=8.4, make_3d=True, calc_properties=True):
+    """Read SMILES from stdin and write one JSON result per line to stdout, keeping the process warm"""
+    ref_fp = reference_fingerprint(reference_smiles, fp_type, radius, n_bits)
+
+    out = sys.stdout
+    count = 0
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        smiles = line.strip()
+        if not smiles:
+            continue
+        count += 1
+        output_base = os.path.join(output_dir, f"mol_{count}")
+        # stdout carries the JSON protocol; progress messages go to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            mol, props, protonated_variants = smiles_to_3d(
+                smiles, output_base, num_confs, protonate=protonate, ph_min=ph_min, ph_max=ph_max,
+                make_3d=make_3d, calc_properties=calc_properties
+            )
+            similarity = None
+            if mol is not None and ref_fp is not None:
+                similarity = _tanimoto_fps(calculate_fingerprint(mol, fp_type, radius, n_bits), ref_fp)
+        out.write(json.dumps({
+            "smiles": smiles,
+            "output": output_base if mol is not None and make_3d else None,
+            "properties": props,
+            "protonation_states": protonated_variants,
+            "similarity": similarity
+        }) + "\n")
+        out.flush()
 
 def is_valid_smiles(smiles):
     """Check if a string is a valid SMILES using RDKit."""
@@ -231,6 +700,11 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--input', help='SMILES string or input file')
     parser.add_argument('-o', '--output', default="output", help='Output directory or base name')
     parser.add_argument('-n', '--num_confs', type=int, default=10, help='Number of conformers to generate')
+    parser.add_argument('-j', '--nproc', type=int, default=None, help='Worker processes for batch mode (default: all cores)')
+    parser.add_argument('--gpu', action='store_true', help='Generate and optimize batch conformers on the GPU (requires nvMolKit; optimizes with MMFF94, not MMFF94s)')
+    parser.add_argument('--server', action='store_true', help='Read SMILES from stdin and write JSON results to stdout')
+    parser.add_argument('--no-3d', dest='no_3d', action='store_true', help='Skip 3D generation and file export (properties/similarity only)')
+    parser.add_argument('--no-properties', dest='no_properties', action='store_true', help='Skip property calculation')
 
     # Protonation arguments
     parser.add_argument('--protonate', action='store_true', help='Enable protonation using Dimorphite-DL')
@@ -238,6 +712,7 @@ if __name__ == "__main__":
     parser.add_argument('--ph_max', type=float, default=8.4, help='Maximum pH for protonation (default: 8.4)')
     parser.add_argument('--precision', type=float, default=1.0, help='pKa precision factor (default: 1.0)')
     parser.add_argument('--max_variants', type=int, default=128, help='Maximum protonation variants (default: 128)')
+    parser.add_argument('--protonation_cache', help='Directory for a persistent protonation cache (requires diskcache)')
 
     # Similarity arguments
     parser.add_argument('--reference', help='Reference SMILES for Tanimoto similarity')
@@ -247,14 +722,23 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    if os.path.isfile(args.input):
+    if args.server:
+        set_protonation_cache(args.protonation_cache)
+        os.makedirs(args.output, exist_ok=True)
+        serve(
+            args.output, args.num_confs, args.reference, args.fp_type, args.radius, args.bits,
+            args.protonate, args.ph_min, args.ph_max, not args.no_3d, not args.no_properties
+        )
+    elif os.path.isfile(args.input):
         os.makedirs(args.output, exist_ok=True)
         batch_process(
             args.input, args.output, args.reference, args.fp_type, args.radius, args.bits,
-            args.protonate, args.ph_min, args.ph_max, args.num_confs
+            args.protonate, args.ph_min, args.ph_max, args.num_confs, args.nproc, args.gpu,
+            args.protonation_cache, not args.no_3d, not args.no_properties
         )
     else:
+        set_protonation_cache(args.protonation_cache)
         single_process(
             args.input, args.output, args.num_confs, args.reference, args.fp_type, args.radius, args.bits,
-            args.protonate, args.ph_min, args.ph_max
+            args.protonate, args.ph_min, args.ph_max, not args.no_3d, not args.no_properties
         )